@@ -26,5 +26,6 @@ def get_train_test_args():
     parser.add_argument('--sub-file', type=str, default='')
     parser.add_argument('--visualize-predictions', action='store_true')
     parser.add_argument('--eval-every', type=int, default=5000)
+    parser.add_argument('--compile', action='store_true') # torch.compile the auxmlm forward (requires torch >= 2.0)
     args = parser.parse_args()
     return args
@@ -1,4 +1,4 @@
-import copy
+import contextlib
 import math
 import random
 
@@ -10,6 +10,7 @@ import torch.distributions.geometric as geom
 from torch.nn import CrossEntropyLoss
 
 from transformers import DistilBertPreTrainedModel, DistilBertModel
+from transformers.models.distilbert.modeling_distilbert import MultiHeadSelfAttention, TransformerBlock
 
 MASK_TOKEN = -100 # is this best way of initializing this?
 PAD_TOKEN = 0
@@ -17,17 +18,70 @@ CLS_TOKEN = 101
 SEP_TOKEN = 102
 GAMMAS_INIT = [0.0]
 
+# membership test for token ids; torch.isin is only available from torch 1.10 onwards
+def isin(elements, test_elements):
+    if hasattr(torch, 'isin'):
+        return torch.isin(elements, test_elements)
+    return (elements.unsqueeze(-1) == test_elements).any(dim=-1)
+
+# turn sampled spans into masked inputs and labels; scripted so the elementwise chain runs without Python dispatch
+@torch.jit.script
+def apply_span_mask(inputs, labels, start_idxs, end_idxs, choice, special_tokens_mask, random_words,
+                    mask_token: int, max_spanlen: int):
+    masked_spans = choice == 0 # spans that will use [MASK]
+    random_spans = choice == 1 # spans that will use random words
+
+    # compare every token position against every span: (bs, nspans, sent_len), at most max_spanlen tokens per span
+    pos = torch.arange(inputs.size(1), device=inputs.device).view(1, 1, -1)
+    span_ends = torch.min(end_idxs, start_idxs + max_spanlen)
+    covered = (pos >= start_idxs.unsqueeze(-1)) & (pos < span_ends.unsqueeze(-1))
+
+    # reduce over spans to get the masking and randomized indices, never touching protected tokens
+    masked_indices = (covered & masked_spans.unsqueeze(-1)).any(dim=1) & ~special_tokens_mask
+    random_indices = (covered & random_spans.unsqueeze(-1)).any(dim=1) & ~special_tokens_mask
+
+    # mask inputs and labels
+    labels = labels.masked_fill(~(masked_indices | random_indices), -100)
+    inputs = inputs.masked_fill(masked_indices, mask_token)
+    inputs = torch.where(random_indices, random_words, inputs)
+    return inputs, labels
+
+# DistilBERT self-attention that uses the fused (Flash / memory-efficient) kernels when torch provides them
+class SDPAMultiHeadSelfAttention(MultiHeadSelfAttention):
+    def forward(self, query, key, value, mask, head_mask=None, output_attentions=False):
+        # the fused kernel never materializes the attention weights, so fall back when they are needed
+        if not hasattr(F, 'scaled_dot_product_attention') or head_mask is not None or output_attentions:
+            return super().forward(query, key, value, mask, head_mask=head_mask, output_attentions=output_attentions)
+
+        bs, q_length, dim = query.size()
+        k_length = key.size(1)
+        dim_per_head = self.dim // self.n_heads
+
+        def shape(x):
+            return x.view(bs, -1, self.n_heads, dim_per_head).transpose(1, 2)
+
+        q = shape(self.q_lin(query))  # (bs, n_heads, q_length, dim_per_head)
+        k = shape(self.k_lin(key))  # (bs, n_heads, k_length, dim_per_head)
+        v = shape(self.v_lin(value))  # (bs, n_heads, k_length, dim_per_head)
+        attn_mask = (mask != 0).view(bs, 1, 1, k_length)  # True where attention is allowed
+
+        context = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                                 dropout_p=self.dropout.p if self.training else 0.0)
+        context = context.transpose(1, 2).reshape(bs, q_length, self.n_heads * dim_per_head)
+        return (self.out_lin(context),)
+
+# TransformerBlock whose attention goes through SDPAMultiHeadSelfAttention; parameter names are unchanged
+class SDPATransformerBlock(TransformerBlock):
+    def __init__(self, config):
+        super().__init__(config)
+        self.attention = SDPAMultiHeadSelfAttention(config)
+
 class AuxMLMModel(DistilBertPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
 
         self.distilbert = DistilBertModel(config)
-        self.qa_transformer_layer = copy.deepcopy(self.distilbert.transformer.layer[0])
-
-        for layer in self.qa_transformer_layer.children(): # this may be missing a few of the more nested children layers...
-            for sublayer in layer.children():              # but I think the important layers are all reset
-                if hasattr(sublayer, 'reset_parameters'):
-                    sublayer.reset_parameters()
+        self.qa_transformer_layer = SDPATransformerBlock(config) # freshly initialized by init_weights() below
 
         self.qa_outputs = nn.Linear(config.dim, config.num_labels)
         assert config.num_labels == 2
@@ -37,29 +91,57 @@ class AuxMLMModel(DistilBertPreTrainedModel):
         self.vocab_layer_norm = nn.LayerNorm(config.dim, eps=1e-12)
         self.vocab_projector = nn.Linear(config.dim, config.vocab_size)
 
+        # init_weights() also ties vocab_projector.weight to the input word embeddings (via get_output_embeddings()),
+        # so the projector does not hold a second vocab_size x dim matrix; from_pretrained() re-ties after loading
         self.init_weights()
 
         self.mlm_probability = 0.15 # this is default for BERT and RoBERTa
         self.len_probability = 0.2 # span_length prob for geometric distribution
         self.max_spanlen = 2 # length of largest acceptable span
 
-        self.mlm_loss_fct = nn.CrossEntropyLoss()
+        # cumulative probabilities splitting masked tokens into [MASK] (80%), random word (10%), unchanged (10%)
+        self.register_buffer('replace_boundaries', torch.tensor([0.8, 0.9]), persistent=False)
+        # which tokens can't be masked? [CLS], [SEP], [PAD]
+        self.register_buffer('special_ids', torch.tensor([CLS_TOKEN, SEP_TOKEN, PAD_TOKEN]), persistent=False)
+        self.register_buffer('zero_scalar', torch.zeros(()), persistent=False)
+        self._prob_cache = {} # constant probability tensors keyed by (shape, prob, device)
 
         self.vocab_size = None
         self.mask_token = MASK_TOKEN # maybe should come up with a better way of initializing this, in case we want to change it?
-        self.gamma_idx = 0
-        self.gammas = GAMMAS_INIT
+        # gamma schedule and step counter live on the device so forward never mutates Python state
+        self.register_buffer('gammas_t', torch.tensor(GAMMAS_INIT), persistent=False)
+        self.register_buffer('gamma_idx_t', torch.zeros((), dtype=torch.long), persistent=False)
+        self.return_mlm_logits = False # compute MLM logits even when inputs are not masked
+        self._compiled_forward = None
 
     def set_mask_token(self, mask_token):
         self.mask_token = mask_token
 
+    def set_return_mlm_logits(self, return_mlm_logits):
+        self.return_mlm_logits = return_mlm_logits
+
     # rely on the training function to set the gammas as a function of training step
     def set_gammas(self, gammas):
-        self.gammas = gammas
-        self.gamma_idx = 0
+        self.gammas_t = torch.as_tensor(gammas, dtype=torch.float, device=self.gammas_t.device)
+        self.gamma_idx_t.zero_()
 
+    # past the end of the schedule we keep using the last gamma
     def get_gamma(self):
-        return self.gammas[self.gamma_idx]
+        return self.gammas_t[self.gamma_idx_t.clamp(max=self.gammas_t.numel() - 1)]
+
+    # bf16 autocast for training on GPUs that support it (losses are kept in fp32 by autocast), full precision otherwise
+    def _autocast(self):
+        enabled = (self.training and self.device.type == 'cuda' and hasattr(torch, 'autocast')
+                   and torch.cuda.is_bf16_supported())
+        if not enabled:
+            return contextlib.ExitStack() # no-op context; contextlib.nullcontext needs Python 3.7
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+    # compile the dense part of forward (everything after masking, which draws fresh random spans every step)
+    def enable_compile(self, mode='reduce-overhead'):
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('AuxMLMModel.enable_compile() requires torch >= 2.0')
+        self._compiled_forward = torch.compile(self._forward_impl, mode=mode, fullgraph=False)
 
     # from MLM
     def get_output_embeddings(self):
@@ -69,6 +151,13 @@ class AuxMLMModel(DistilBertPreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.vocab_projector = new_embeddings
 
+    # probability tensors are constant for a given input shape, so build them once and reuse them every step
+    def get_prob_tensor(self, shape, prob, device):
+        key = (tuple(shape), prob, device)
+        if key not in self._prob_cache:
+            self._prob_cache[key] = torch.full(shape, prob, device=device)
+        return self._prob_cache[key]
+
     # add vocabulary size to model for MLM
     def add_vocab_size(self, vocab_size):
         # vocab should be a list of strings
@@ -83,59 +172,32 @@ class AuxMLMModel(DistilBertPreTrainedModel):
         labels = inputs.clone()
 
         # detect tokens we should not mask
-        special_tokens_mask = torch.zeros_like(inputs, device=inputs.device)
-        special_tokens_mask[inputs == CLS_TOKEN] = 1 # which tokens can't be masked? [CLS], [SEP], [PAD]
-        special_tokens_mask[inputs == SEP_TOKEN] = 1
-        special_tokens_mask[inputs == PAD_TOKEN] = 1
-        special_tokens_mask = special_tokens_mask.bool()
+        special_tokens_mask = isin(inputs, self.special_ids)
 
         #import pdb; pdb.set_trace()
         # Get the largest geometric sample of span lengths (batch_size, sent_len), clamped  
-        ldist = geom.Geometric(torch.full(labels.shape, self.len_probability, device=inputs.device)).sample()
-        ldist_trunc = torch.clamp(ldist, min=0.0, max=self.max_spanlen).float() + torch.ones_like(ldist).float() # geom produces [0, inf), we want 1-8
+        ldist = geom.Geometric(self.get_prob_tensor(labels.shape, self.len_probability, inputs.device)).sample()
+        ldist_trunc = torch.clamp(ldist, min=0.0, max=self.max_spanlen) + 1 # geom produces [0, inf), we want 1-8
         sent_len = labels.shape[1] # lengths of input sentences (could pass this to the constructor)
 
         nmask = math.ceil(sent_len * self.mlm_probability)    # number of total modifications expected
-        cumul = torch.cumsum(ldist_trunc, dim=1, dtype=float) # accumulate span lengths 
-        lengths = torch.where(cumul < (nmask + 1 / self.len_probability) , ldist_trunc, torch.Tensor([0.]).to(inputs.device)) # only consider lengths up to ~nmask
-        nspans = torch.unsqueeze(torch.count_nonzero(lengths, dim = 1), dim =1) # number of spans in each sentence
-        lengths = lengths[:, :torch.max(nspans)]              # truncate length tensor to max span length
+        cumul = torch.cumsum(ldist_trunc, dim=1, dtype=torch.float32) # accumulate span lengths 
+        lengths = torch.where(cumul < (nmask + 1 / self.len_probability) , ldist_trunc, self.zero_scalar) # only consider lengths up to ~nmask
+        max_spans = nmask + math.ceil(1 / self.len_probability) # every span has length >= 1, so this bounds the span count
+        lengths = lengths[:, :max_spans].long()                # truncate length tensor without syncing on the actual span count
 
 
         # randomly (uniformly) generate anchoring indices for each span length, get ending indices
-        start_idxs = torch.ceil(torch.rand_like(lengths, dtype=float) * sent_len).float()
-        start_idxs = torch.where(lengths > 0., start_idxs, torch.Tensor([0.]).to(inputs.device)) # ignore indices with 0 length
+        start_idxs = torch.randint(1, sent_len + 1, lengths.shape, device=inputs.device, dtype=torch.long)
+        start_idxs = start_idxs.masked_fill(lengths == 0, 0) # ignore indices with 0 length
         end_idxs = start_idxs + lengths # calculate stop indices for each span
-        end_idxs = torch.clamp(end_idxs, min=0.0, max=sent_len) # clamp end indices 
-
-        masked_spans =  torch.bernoulli(torch.full(lengths.shape, 0.8, device=inputs.device)).bool() # spans that will use [MASK]
-        random_spans  = torch.bernoulli(torch.full(lengths.shape, 0.5, device=inputs.device)).bool() & ~masked_spans
-        masked_spans = masked_spans.int(); random_spans = random_spans.int()
-        masked_indices = torch.zeros_like(inputs, device=inputs.device, dtype=torch.int64) # initialize masks
-        random_indices = torch.zeros_like(inputs, device=inputs.device, dtype=torch.int64) # initialize randomized indices
-        increment = torch.ones_like(start_idxs).type(torch.LongTensor).to(inputs.device) # used to increment span indices
-        current_idxs = start_idxs
-
-        # fill in masking and randomized indices consecutively
-        for i in range(self.max_spanlen):
-            token_indices = torch.where(current_idxs < end_idxs, current_idxs, torch.Tensor([0.]).to(inputs.device)).type(torch.LongTensor).to(inputs.device)
-            masked_indices.scatter_(1, token_indices * masked_spans, increment) # we scatter from a tensor of all 1s
-            random_indices.scatter_(1, token_indices * random_spans, increment)
-            current_idxs += increment
-        
-        # prevent masking protected tokens and convert to boolean tensors
-        masked_indices.masked_fill_(special_tokens_mask, value=0)
-        random_indices.masked_fill_(special_tokens_mask, value=0)
-        masked_indices = masked_indices.bool()
-        random_indices = random_indices.bool()
-
-        # mask inputs and labels
-        labels[~(masked_indices | random_indices)] = -100
+        end_idxs = torch.clamp(end_idxs, min=0, max=sent_len) # clamp end indices 
+
+        choice = torch.bucketize(torch.rand(lengths.shape, device=inputs.device), self.replace_boundaries) # 0: [MASK], 1: random, 2: keep
         random_words = torch.randint(self.vocab_size, labels.shape, dtype=torch.long, device=inputs.device)
-        inputs[masked_indices] = self.mask_token
-        inputs[random_indices] = random_words[random_indices]
 
-        return inputs, labels
+        return apply_span_mask(inputs, labels, start_idxs, end_idxs, choice, special_tokens_mask, random_words,
+                               self.mask_token, self.max_spanlen)
         
    
     # Synchronous masking for MLM task
@@ -149,24 +211,23 @@ class AuxMLMModel(DistilBertPreTrainedModel):
         labels = inputs.clone()
 
         # We sample a few tokens in each sequence for MLM training (15%)
-        probability_matrix = torch.full(labels.shape, self.mlm_probability, device=inputs.device)
+        probability_matrix = self.get_prob_tensor(labels.shape, self.mlm_probability, inputs.device)
 
-        special_tokens_mask = torch.zeros_like(inputs, device=inputs.device)
-        special_tokens_mask[inputs == CLS_TOKEN] = 1 # which tokens can't be masked? [CLS], [SEP], [PAD]
-        special_tokens_mask[inputs == SEP_TOKEN] = 1
-        special_tokens_mask[inputs == PAD_TOKEN] = 1
-        special_tokens_mask = special_tokens_mask.bool()
+        special_tokens_mask = isin(inputs, self.special_ids)
 
-        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
+        probability_matrix = probability_matrix.masked_fill(special_tokens_mask, value=0.0) # out of place, the cached tensor is shared
         masked_indices = torch.bernoulli(probability_matrix).bool()
         labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
+        # draw a single categorical sample per token: 0 -> [MASK], 1 -> random word, 2 -> unchanged
+        choice = torch.bucketize(torch.rand(labels.shape, device=inputs.device), self.replace_boundaries)
+
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=inputs.device)).bool() & masked_indices
+        indices_replaced = masked_indices & (choice == 0)
         inputs[indices_replaced] = self.mask_token
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=inputs.device)).bool() & masked_indices & ~indices_replaced
+        indices_random = masked_indices & (choice == 1)
         random_words = torch.randint(self.vocab_size, labels.shape, dtype=torch.long, device=inputs.device)
         inputs[indices_random] = random_words[indices_random]
 
@@ -205,6 +266,58 @@ class AuxMLMModel(DistilBertPreTrainedModel):
         else:
             mlm_labels = input_ids # we don't care about MLM if we are not masking inputs
 
+        # evaluation stays eager: CUDA graphs overwrite their static outputs on the next run, but evaluate() keeps
+        # the logits of every batch around
+        use_compiled = self._compiled_forward is not None and self.training
+        forward_impl = self._compiled_forward if use_compiled else self._forward_impl
+        with self._autocast():
+            qa_loss, mlm_loss, output = forward_impl(
+                input_ids,
+                mlm_labels,
+                attention_mask=attention_mask,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                start_positions=start_positions,
+                end_positions=end_positions,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+                mask_inputs=mask_inputs,
+            )
+
+        gamma_current = self.get_gamma()
+        if decay_gamma:
+            self.gamma_idx_t.add_(1)
+
+        # compute total loss        
+        if qa_loss is None:
+            total_loss = gamma_current * mlm_loss
+        else:
+            total_loss = qa_loss + gamma_current *  mlm_loss
+
+        return ((total_loss,) + output) if total_loss is not None else output
+
+    # MLM head up to the vocab projection; under enable_compile() it is traced as part of _forward_impl,
+    # where Inductor fuses GELU and LayerNorm into a single pass
+    def _mlm_head_pre(self, hidden_states):
+        return self.vocab_layer_norm(F.gelu(self.vocab_transform(hidden_states)))
+
+    # everything in forward after masking; it is the part handed to torch.compile, so when compiled it avoids
+    # data-dependent shapes (see the MLM loss below)
+    def _forward_impl(
+        self,
+        input_ids,
+        mlm_labels,
+        attention_mask=None,
+        head_mask=None,
+        inputs_embeds=None,
+        start_positions=None,
+        end_positions=None,
+        output_attentions=None,
+        output_hidden_states=None,
+        return_dict=None,
+        mask_inputs=False,
+    ):
         # This is the result of DistilbertModel's forward method
         distilbert_output = self.distilbert(
             input_ids=input_ids,
@@ -220,18 +333,16 @@ class AuxMLMModel(DistilBertPreTrainedModel):
 
         hidden_states_qa = self.qa_transformer_layer(distilbert_output[0], attn_mask=attention_mask, output_attentions=output_attentions)[-1]
         
-        # Compute logits from MLM
-        prediction_logits = self.vocab_transform(hidden_states)  # (bs, max_query_length, dim)
-        prediction_logits = F.gelu(prediction_logits)  # (bs, max_query_length, dim)
-        prediction_logits = self.vocab_layer_norm(prediction_logits)  # (bs, max_query_length, dim)
-        prediction_logits = self.vocab_projector(prediction_logits)  # (bs, max_query_length, vocab_size)
+        # Compute logits from MLM, skipping the vocab-sized projection when nobody needs it
+        prediction_logits = None
+        if mask_inputs or self.return_mlm_logits:
+            prediction_logits = self._mlm_head_pre(hidden_states)  # (bs, max_query_length, dim)
+            prediction_logits = self.vocab_projector(prediction_logits)  # (bs, max_query_length, vocab_size)
 
         # Compute logits from QA
         hidden_states_qa = self.dropout(hidden_states_qa)  # (bs, max_query_len, dim)
         logits = self.qa_outputs(hidden_states_qa)  # (bs, max_query_len, 2)
-        start_logits, end_logits = logits.split(1, dim=-1)
-        start_logits = start_logits.squeeze(-1)  # (bs, max_query_len)
-        end_logits = end_logits.squeeze(-1)  # (bs, max_query_len)
+        start_logits, end_logits = logits.unbind(dim=-1)  # (bs, max_query_len) each
 
         # Compute Cross-Entropy Loss from QA
         qa_loss = None
@@ -243,37 +354,27 @@ class AuxMLMModel(DistilBertPreTrainedModel):
                 end_positions = end_positions.squeeze(-1)
             # sometimes the start/end positions are outside our model inputs, we ignore these terms
             ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
+            start_positions = start_positions.clamp(0, ignored_index) # out of place: CUDA graphs skip input-mutating graphs
+            end_positions = end_positions.clamp(0, ignored_index)
 
-            loss_fct = nn.CrossEntropyLoss(ignore_index=ignored_index)
-            qa_start_loss = loss_fct(start_logits, start_positions)
-            qa_end_loss = loss_fct(end_logits, end_positions)
+            qa_start_loss = F.cross_entropy(start_logits, start_positions, ignore_index=ignored_index)
+            qa_end_loss = F.cross_entropy(end_logits, end_positions, ignore_index=ignored_index)
             qa_loss = (qa_start_loss + qa_end_loss) / 2
 
         # Compute Cross-Entropy Loss from MLM, but only if we are actually masking inputs
-        # note: CrossEntropyLoss automatically ignores all positions with value -100
+        # note: eagerly, only masked positions (label != -100) are gathered so the vocab softmax skips the rest;
+        # the gather has a data-dependent shape, so the compiled path keeps the full-size loss with ignore_index
         mlm_loss = 0
         if mask_inputs:
-            mlm_loss = self.mlm_loss_fct(prediction_logits.view(-1, prediction_logits.size(-1)), mlm_labels.view(-1))
+            if self._compiled_forward is not None:
+                mlm_loss = F.cross_entropy(prediction_logits.view(-1, prediction_logits.size(-1)), mlm_labels.view(-1),
+                                           ignore_index=-100)
+            else:
+                keep = mlm_labels.ne(-100)
+                mlm_loss = F.cross_entropy(prediction_logits[keep], mlm_labels[keep])  # (n_masked, vocab_size)
 
-        # check that global_idx does not exceed size of gammas
-        if self.gamma_idx > len(self.gammas) - 1:
-            gamma_current = self.gammas[-1]
-        else:
-            gamma_current = self.gammas[self.gamma_idx]
-
-        if decay_gamma:
-            self.gamma_idx += 1
-
-        # compute total loss        
-        if qa_loss is None:
-            total_loss = gamma_current * mlm_loss
-        else:
-            total_loss = qa_loss + gamma_current *  mlm_loss
-            
         output = (start_logits, end_logits, prediction_logits) + distilbert_output[1:]
 
-        return ((total_loss,) + output) if total_loss is not None else output
+        return qa_loss, mlm_loss, output
 
 
@@ -365,6 +365,8 @@ def main():
             n_steps = (args.num_epochs) * len(train_loader) # is this the correct number of batches per epoch?
             gammas = get_gammas(gamma_start, gamma_end, n_steps, "linear")
             model.set_gammas(gammas)
+            if args.compile:
+                model.enable_compile()
 
         best_scores = trainer.train(model, train_loader, val_loader, val_dict, args.model)
 